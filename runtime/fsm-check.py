@@ -1,11 +1,43 @@
 #!/usr/bin/env python3
 import argparse
+import contextlib
+import mmap
 import struct
 import json
+import os
 import re
 import sys
+from collections.abc import Callable, Iterator
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; sideband decoding falls back to struct
+    np = None
+
+
+# TAG:<STATE> marker in an asm buffer.
+_TAG_RE = re.compile(rb"TAG:([A-Za-z0-9_]+)")
+
+# Every boundary str.splitlines() breaks on, as UTF-8 bytes: bare CR as well as
+# LF, plus VT, FF, FS/GS/RS, NEL, and the Unicode line/paragraph separators.
+_LINE_END_RE = re.compile(rb"[\n\r\v\f\x1c-\x1e]|\xc2\x85|\xe2\x80[\xa8\xa9]")
+
+# Inputs at least this large are memory-mapped instead of read into the heap.
+_MMAP_THRESHOLD = 1024 * 1024
+
+# Asm inputs at least this large are scanned in line-aligned chunks by a
+# process pool; the re engine holds the GIL, so threads would not help. The
+# single-threaded scan runs at roughly 0.5 GB/s, and each worker pays an
+# interpreter (and, under spawn/forkserver, numpy) import, so the pool only
+# pays off for very large files and a few workers.
+_PARALLEL_SCAN_THRESHOLD = 1024 * 1024 * 1024
+_MAX_SCAN_WORKERS = 4
+
+# Largest state ID for which sideband decoding builds a dense ID -> state table.
+_MAX_DENSE_STATE_ID = 1 << 20
+
 
 def parse_args() -> argparse.Namespace:
     p = argparse.ArgumentParser(
@@ -25,16 +57,88 @@ def load_policy(path: Path) -> dict:
         return json.load(f)
 
 
-def extract_tags(asm_text: str) -> list[str]:
+def _map_sequential(f) -> mmap.mmap:
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    # Inputs are scanned front to back: ask for aggressive readahead.
+    if hasattr(mmap, "MADV_SEQUENTIAL"):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+    return mm
+
+
+@contextlib.contextmanager
+def open_input_buffer(path: Path) -> Iterator[bytes | mmap.mmap]:
+    if path.stat().st_size < _MMAP_THRESHOLD:
+        yield path.read_bytes()
+        return
+    with path.open("rb") as f:
+        mm = _map_sequential(f)
+        try:
+            yield mm
+        except BaseException:
+            # A zero-copy view of the map (np.frombuffer) may still be pinned by
+            # the propagating traceback; let the original error surface rather
+            # than "BufferError: cannot close exported pointers exist".
+            try:
+                mm.close()
+            except BufferError:
+                pass
+            raise
+        mm.close()
+
+
+def extract_tags(
+    asm_bytes: bytes | mmap.mmap, start: int = 0, end: int = sys.maxsize
+) -> list[str]:
+    # One scan over the whole buffer that keeps the regex's literal-prefix
+    # search; only the first marker on each line counts, so matches before the
+    # end of the last accepted line are skipped. Line ends are the ones
+    # str.splitlines() recognises, so CR-only files split as they did when read
+    # as text. Markers are ASCII, so no UTF-8 decode pass is needed.
     tags: list[str] = []
-    pattern = re.compile(r"TAG:([A-Za-z0-9_]+)")
-    for line in asm_text.splitlines():
-        m = pattern.search(line)
-        if m:
-            tags.append(m.group(1))
+    line_end = -1
+    for m in _TAG_RE.finditer(asm_bytes, start, end):
+        if m.start() < line_end:
+            continue
+        tags.append(sys.intern(m.group(1).decode("ascii")))
+        line_end_m = _LINE_END_RE.search(asm_bytes, m.end())
+        line_end = sys.maxsize if line_end_m is None else line_end_m.start()
     return tags
 
 
+def _line_aligned_chunks(buf: bytes | mmap.mmap, count: int) -> list[tuple[int, int]]:
+    # Chunks end just past a newline, so no marker line straddles two chunks and
+    # the per-chunk results concatenate without any overlap handling.
+    size = len(buf)
+    step = max(1, -(-size // count))
+    chunks: list[tuple[int, int]] = []
+    start = 0
+    while start < size:
+        newline = buf.find(b"\n", start + step - 1)
+        end = size if newline < 0 else newline + 1
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+
+def _scan_asm_chunk(path: str, start: int, end: int) -> list[str]:
+    with open(path, "rb") as f, _map_sequential(f) as mm:
+        return extract_tags(mm, start, end)
+
+
+def extract_tags_from_asm_file(asm_path: Path) -> list[str]:
+    workers = min(os.cpu_count() or 1, _MAX_SCAN_WORKERS)
+    with open_input_buffer(asm_path) as asm_bytes:
+        if workers < 2 or len(asm_bytes) < _PARALLEL_SCAN_THRESHOLD:
+            return extract_tags(asm_bytes)
+        chunks = _line_aligned_chunks(asm_bytes, workers)
+
+    starts, ends = zip(*chunks)
+    with ProcessPoolExecutor(max_workers=len(chunks)) as pool:
+        results = pool.map(_scan_asm_chunk, [str(asm_path)] * len(chunks), starts, ends)
+        # Interning does not survive the trip back from the workers.
+        return [sys.intern(tag) for chunk_tags in results for tag in chunk_tags]
+
+
 def _parse_state_id(value: object) -> int:
     if isinstance(value, int):
         return value
@@ -43,49 +147,163 @@ def _parse_state_id(value: object) -> int:
     raise ValueError(f"Invalid state ID type: {type(value)}")
 
 
-def extract_tags_from_sideband(sideband_bytes: bytes, policy: dict) -> list[str]:
+def state_ids(policy: dict) -> dict[int, str]:
+    id_to_state: dict[int, str] = {}
+    for state, raw_id in policy.get("ids", {}).items():
+        parsed = _parse_state_id(raw_id)
+        id_to_state[parsed] = sys.intern(state)
+    return id_to_state
+
+
+def decode_ids(sideband_bytes: bytes | mmap.mmap) -> "np.ndarray | list[int]":
     if len(sideband_bytes) % 4 != 0:
         raise ValueError(
             f"Sideband stream length ({len(sideband_bytes)}) is not a multiple of 4 bytes."
         )
+    if np is None:
+        return [raw_id for (raw_id,) in struct.iter_unpack("<I", sideband_bytes)]
+    # Zero-copy view; for mmap input it must be dropped before the map is closed.
+    return np.frombuffer(sideband_bytes, dtype="<u4")
 
-    ids = policy.get("ids", {})
-    id_to_state: dict[int, str] = {}
-    for state, raw_id in ids.items():
-        parsed = _parse_state_id(raw_id)
-        id_to_state[parsed] = state
 
-    tags: list[str] = []
-    for (raw_id,) in struct.iter_unpack("<I", sideband_bytes):
-        tags.append(id_to_state.get(raw_id, f"ID_{raw_id}"))
+def _lookup_ids(ids: "np.ndarray", table: dict[int, int]) -> "np.ndarray | None":
+    # Resolve every raw ID with one fancy-index into a dense lookup table
+    # instead of a dict lookup per record; -1 marks IDs missing from table.
+    # Returns None when the table's keys are negative or too sparse to densify.
+    if not table or not 0 <= min(table) <= max(table) <= _MAX_DENSE_STATE_ID:
+        return None
+    max_id = max(table)
+    lut = np.full(max_id + 1, -1, dtype=np.int32)
+    for raw_id, value in table.items():
+        lut[raw_id] = value
+    return np.where(ids <= max_id, lut[np.minimum(ids, max_id)], -1)
+
+
+def ids_to_names(ids: "np.ndarray | list[int]", id_to_state: dict[int, str]) -> list[str]:
+    mapped = None
+    if np is not None:
+        mapped = _lookup_ids(ids, {raw_id: i for i, raw_id in enumerate(id_to_state)})
+    if mapped is None:
+        raw_ids = ids if isinstance(ids, list) else ids.tolist()
+        return [
+            state if (state := id_to_state.get(raw_id)) is not None else f"ID_{raw_id}"
+            for raw_id in raw_ids
+        ]
+
+    states = list(id_to_state.values())
+    unknown = mapped < 0
+    if not unknown.any():
+        return [states[i] for i in mapped.tolist()]
+
+    # Unknown IDs are expected to be rare, so only their positions are
+    # formatted; index -1 picks up a placeholder until then.
+    states.append("")
+    tags = [states[i] for i in mapped.tolist()]
+    for pos in np.flatnonzero(unknown).tolist():
+        tags[pos] = f"ID_{int(ids[pos])}"
     return tags
 
 
-def validate(tags: list[str], policy: dict) -> tuple[bool, list[str]]:
+def build_transition_table(policy: dict) -> tuple[dict[str, int], "np.ndarray"]:
+    # Compact state indices follow policy "ids" order, then any state that only
+    # appears in "transitions". The extra last row/column stands for tags the
+    # policy does not name: nothing may leave or enter it.
+    transitions = policy.get("transitions", {})
+    index: dict[str, int] = {}
+    for state in policy.get("ids", {}):
+        index.setdefault(sys.intern(state), len(index))
+    for state, nexts in transitions.items():
+        index.setdefault(sys.intern(state), len(index))
+        for n in nexts:
+            index.setdefault(sys.intern(n), len(index))
+
+    # allowed[prev, curr]: each state's outgoing row is contiguous in memory.
+    allowed = np.zeros((len(index) + 1, len(index) + 1), dtype=bool)
+    for state, nexts in transitions.items():
+        for n in nexts:
+            allowed[index[state], index[n]] = True
+    return index, allowed
+
+
+def _illegal_steps(tags: list[str], policy: dict) -> list[int]:
+    # Positions i at which tags[i] -> tags[i + 1] is not an allowed transition.
+    # Tags are interned by the extractors, so interning the policy side lets
+    # dict and set lookups succeed on identity without comparing characters.
+    transition_sets = {
+        sys.intern(state): frozenset(sys.intern(n) for n in nexts)
+        for state, nexts in policy.get("transitions", {}).items()
+    }
+    steps: list[int] = []
+    for i, (prev, curr) in enumerate(zip(tags, tags[1:])):
+        allowed = transition_sets.get(prev)
+        if allowed is None or curr not in allowed:
+            steps.append(i)
+    return steps
+
+
+def _report(
+    tag_at: Callable[[int], str], count: int, steps: list[int], policy: dict
+) -> tuple[bool, list[str]]:
     errors: list[str] = []
     transitions = policy.get("transitions", {})
     start = policy.get("start")
-    accept = set(policy.get("accept", []))
+    accept = {sys.intern(state) for state in policy.get("accept", [])}
 
-    if not tags:
+    if not count:
         return False, ["No TAG:<STATE> markers were found in asm output."]
 
-    if start and tags[0] != start:
-        errors.append(f"First tag '{tags[0]}' does not match required start state '{start}'.")
+    first = tag_at(0)
+    if start and first != start:
+        errors.append(f"First tag '{first}' does not match required start state '{start}'.")
 
-    for prev, curr in zip(tags, tags[1:]):
-        allowed = transitions.get(prev, [])
-        if curr not in allowed:
-            errors.append(
-                f"Illegal transition {prev} -> {curr}. Allowed next states: {allowed}."
-            )
+    for i in steps:
+        prev, curr = tag_at(i), tag_at(i + 1)
+        errors.append(
+            f"Illegal transition {prev} -> {curr}. "
+            f"Allowed next states: {transitions.get(prev, [])}."
+        )
 
-    if accept and tags[-1] not in accept:
-        errors.append(f"Final tag '{tags[-1]}' is not in accept set {sorted(accept)}.")
+    last = tag_at(count - 1)
+    if accept and last not in accept:
+        errors.append(f"Final tag '{last}' is not in accept set {sorted(accept)}.")
 
     return len(errors) == 0, errors
 
 
+def validate(tags: list[str], policy: dict) -> tuple[bool, list[str]]:
+    return _report(tags.__getitem__, len(tags), _illegal_steps(tags, policy), policy)
+
+
+def validate_ids(ids: "np.ndarray | list[int]", policy: dict) -> tuple[bool, list[str]]:
+    # Validates the raw sideband ID stream directly; state names are only
+    # produced for the handful of positions that end up in an error message.
+    id_to_state = state_ids(policy)
+    mapped = None
+    if np is not None:
+        index, allowed = build_transition_table(policy)
+        mapped = _lookup_ids(ids, {raw_id: index[state] for raw_id, state in id_to_state.items()})
+    if mapped is None:
+        return validate(ids_to_names(ids, id_to_state), policy)
+
+    trace = np.where(mapped >= 0, mapped, len(index))
+    steps = np.flatnonzero(~allowed[trace[:-1], trace[1:]]).tolist()
+
+    def tag_at(i: int) -> str:
+        raw_id = int(ids[i])
+        return id_to_state.get(raw_id, f"ID_{raw_id}")
+
+    return _report(tag_at, len(ids), steps, policy)
+
+
+def check_sideband(
+    sideband_bytes: bytes | mmap.mmap, policy: dict
+) -> tuple[bool, list[str], list[str]]:
+    # Keeps the decoded view local so it is released before an mmap'd input closes.
+    ids = decode_ids(sideband_bytes)
+    ok, errors = validate_ids(ids, policy)
+    return ok, errors, ids_to_names(ids, state_ids(policy))
+
+
 def main() -> int:
     args = parse_args()
     policy_path = Path(args.policy)
@@ -101,20 +319,20 @@ def main() -> int:
         if not asm_path.exists():
             print(f"ERROR: asm file not found: {asm_path}", file=sys.stderr)
             return 2
-        tags = extract_tags(asm_path.read_text(encoding="utf-8"))
+        tags = extract_tags_from_asm_file(asm_path)
+        ok, errors = validate(tags, policy)
     else:
         sideband_path = Path(args.sideband_bin)
         if not sideband_path.exists():
             print(f"ERROR: sideband file not found: {sideband_path}", file=sys.stderr)
             return 2
         try:
-            tags = extract_tags_from_sideband(sideband_path.read_bytes(), policy)
+            with open_input_buffer(sideband_path) as sideband_bytes:
+                ok, errors, tags = check_sideband(sideband_bytes, policy)
         except ValueError as exc:
             print(f"ERROR: {exc}", file=sys.stderr)
             return 2
 
-    ok, errors = validate(tags, policy)
-
     if ok:
         print("FSM CHECK PASS")
         print("Tag trace:", " -> ".join(tags))
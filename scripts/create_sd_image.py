@@ -13,15 +13,39 @@ from __future__ import annotations
 import argparse
 import hashlib
 import json
+import mmap
+import os
 import shutil
+import struct
 import subprocess
 import sys
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
 from pathlib import Path
 from typing import Iterable
 
+try:
+    from fs.errors import FSError
+    from pyfatfs import PyFATException
+    from pyfatfs.PyFatFS import PyFatFS
+except ImportError:  # pyfatfs is optional; only needed for --pyfatfs
+    PyFatFS = None
+
 
 PARTITION_OFFSET_BYTES = 1 * 1024 * 1024  # 1 MiB
-REQUIRED_TOOLS = ("parted", "mformat", "mcopy", "mmd", "mdir", "dd")
+SECTOR_SIZE = 512
+# Geometry advertised in the MBR CHS fields and the FAT32 BPB.
+SECTORS_PER_TRACK = 63
+HEADS = 255
+FAT32_RESERVED_SECTORS = 32
+FAT32_NUM_FATS = 2
+FAT32_ROOT_CLUSTER = 2
+# Spec-following drivers treat volumes with fewer clusters as FAT12/FAT16.
+FAT32_MIN_CLUSTERS = 65525
+# Files larger than this are hashed through a read-only mmap in one update() call.
+HASH_MMAP_THRESHOLD_BYTES = 64 * 1024
+REQUIRED_TOOLS = ("mmd", "mcopy", "mdir", "dd")
+FORMAT_TOOLS = ("truncate", "parted", "mformat")
 
 
 def parse_args() -> argparse.Namespace:
@@ -59,6 +83,19 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Overwrite output image if it exists.",
     )
+    parser.add_argument(
+        "--builtin-format",
+        action="store_true",
+        help=(
+            "Experimental: write the MBR and FAT32 partition directly instead of "
+            "running parted/mformat."
+        ),
+    )
+    parser.add_argument(
+        "--pyfatfs",
+        action="store_true",
+        help="Copy files into the image in-process with pyfatfs instead of mtools.",
+    )
     parser.add_argument(
         "--flash-device",
         default="",
@@ -76,91 +113,300 @@ def run(cmd: list[str]) -> subprocess.CompletedProcess[str]:
     return subprocess.run(cmd, check=True, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
 
-def ensure_tools_exist() -> None:
-    missing = [tool for tool in REQUIRED_TOOLS if shutil.which(tool) is None]
+def ensure_tools_exist(tools: Iterable[str]) -> None:
+    missing = [tool for tool in tools if shutil.which(tool) is None]
     if missing:
         raise RuntimeError(f"Missing required tools: {', '.join(missing)}")
 
 
-def iter_layout_files(layout_dir: Path) -> Iterable[Path]:
-    for path in sorted(layout_dir.rglob("*")):
-        if path.is_file():
-            yield path
+def iter_layout_files(layout_dir: Path) -> Iterable[tuple[Path, os.stat_result]]:
+    # Depth-first scandir walk with each directory's entries sorted by name;
+    # yields the same order as sorting the full rglob() result, without
+    # materializing the tree or re-stat'ing entries scandir already typed.
+    # The stat result (of the target, for symlinks) is passed along so callers
+    # never stat a layout file again.
+    with os.scandir(layout_dir) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_layout_files(Path(entry.path))
+        elif entry.is_file():
+            yield Path(entry.path), entry.stat()
+
+
+def iter_layout_dirs(layout_dir: Path) -> Iterable[Path]:
+    # Same walk and order as iter_layout_files, yielding every subdirectory
+    # (including empty ones) before anything inside it.
+    with os.scandir(layout_dir) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield Path(entry.path)
+            yield from iter_layout_dirs(Path(entry.path))
 
 
 def sha256_file(path: Path) -> str:
     h = hashlib.sha256()
     with path.open("rb") as f:
-        while True:
-            chunk = f.read(1024 * 1024)
-            if not chunk:
-                break
-            h.update(chunk)
+        # The file is read once, front to back: ask for aggressive readahead.
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if os.fstat(f.fileno()).st_size > HASH_MMAP_THRESHOLD_BYTES:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                h.update(mm)
+        else:
+            h.update(f.read())
     return h.hexdigest()
 
 
-def create_partitioned_image(output_image: Path, size_mb: int, label: str) -> None:
-    output_image.parent.mkdir(parents=True, exist_ok=True)
-    run(["truncate", "-s", f"{size_mb}M", str(output_image)])
-    run(["parted", "-s", str(output_image), "mklabel", "msdos"])
-    run(["parted", "-s", str(output_image), "mkpart", "primary", "fat32", "1MiB", "100%"])
-    run(["parted", "-s", str(output_image), "set", "1", "boot", "on"])
-    run(
-        [
-            "mformat",
-            "-i",
-            f"{output_image}@@{PARTITION_OFFSET_BYTES}",
-            "-F",
-            "-v",
-            label,
-            "::",
-        ]
+def _chs_address(lba: int) -> bytes:
+    # Legacy CHS triple for an MBR entry in the advertised geometry.
+    cylinder, rem = divmod(lba, HEADS * SECTORS_PER_TRACK)
+    if cylinder > 1023:
+        return b"\xfe\xff\xff"
+    head, sector = divmod(rem, SECTORS_PER_TRACK)
+    return bytes((head, ((cylinder >> 2) & 0xC0) | (sector + 1), cylinder & 0xFF))
+
+
+def build_mbr(total_sectors: int) -> bytes:
+    # One bootable FAT32 (LBA) primary partition from 1 MiB to the end of the image.
+    start = PARTITION_OFFSET_BYTES // SECTOR_SIZE
+    count = total_sectors - start
+    mbr = bytearray(SECTOR_SIZE)
+    struct.pack_into("<I", mbr, 0x1B8, int.from_bytes(os.urandom(4), "little"))
+    struct.pack_into(
+        "<B3sB3sII",
+        mbr,
+        0x1BE,
+        0x80,
+        _chs_address(start),
+        0x0C,
+        _chs_address(start + count - 1),
+        start,
+        count,
     )
+    mbr[0x1FE:0x200] = b"\x55\xaa"
+    return bytes(mbr)
+
+
+def _fat32_sectors_per_cluster(volume_sectors: int) -> int:
+    # Cluster sizes from Microsoft's FAT32 table (fatgen103), by volume size.
+    # The table's first row makes volumes of 66600 sectors or fewer an error:
+    # they cannot hold the 65525 clusters that identify a volume as FAT32.
+    if volume_sectors <= 66600:
+        raise RuntimeError(
+            f"FAT32 partition of {volume_sectors} sectors is too small; "
+            "use --size-mb 34 or larger (or drop --builtin-format)"
+        )
+    for limit, sectors in ((532480, 1), (16777216, 8), (33554432, 16), (67108864, 32)):
+        if volume_sectors <= limit:
+            return sectors
+    return 64
 
 
-def mtools_mkdir(image: Path, rel_dir: str) -> None:
-    if not rel_dir:
-        return
-    run(["mmd", "-i", f"{image}@@{PARTITION_OFFSET_BYTES}", f"::{rel_dir}"])
+def build_fat32_volume(volume_sectors: int, label: str) -> list[tuple[int, bytes]]:
+    # (byte offset within the partition, data) pairs that format an all-zero
+    # partition as FAT32, equivalent to `mformat -F -v <label>`.
+    try:
+        volume_label = label.upper().encode("ascii")[:11].ljust(11)
+    except UnicodeEncodeError:
+        raise RuntimeError(f"Volume label must be ASCII: {label!r}") from None
+
+    sectors_per_cluster = _fat32_sectors_per_cluster(volume_sectors)
+    fat_sectors = -(
+        -(volume_sectors - FAT32_RESERVED_SECTORS)
+        // ((256 * sectors_per_cluster + FAT32_NUM_FATS) // 2)
+    )
+    data_start = FAT32_RESERVED_SECTORS + FAT32_NUM_FATS * fat_sectors
+    clusters = (volume_sectors - data_start) // sectors_per_cluster
+    if clusters < FAT32_MIN_CLUSTERS:
+        raise RuntimeError(
+            f"FAT32 partition has {clusters} clusters, below the FAT32 minimum of "
+            f"{FAT32_MIN_CLUSTERS}; use a larger --size-mb (or drop --builtin-format)"
+        )
 
+    boot = bytearray(SECTOR_SIZE)
+    boot[0:3] = b"\xeb\x58\x90"
+    boot[3:11] = b"MSWIN4.1"
+    struct.pack_into(
+        "<HBHBHHBHHHII",
+        boot,
+        11,
+        SECTOR_SIZE,
+        sectors_per_cluster,
+        FAT32_RESERVED_SECTORS,
+        FAT32_NUM_FATS,
+        0,  # root entries (FAT12/16 only)
+        0,  # 16-bit total sectors
+        0xF8,  # fixed media
+        0,  # 16-bit FAT size
+        SECTORS_PER_TRACK,
+        HEADS,
+        PARTITION_OFFSET_BYTES // SECTOR_SIZE,  # hidden sectors before the volume
+        volume_sectors,
+    )
+    struct.pack_into(
+        "<IHHIHH12xBxBI11s8s",
+        boot,
+        36,
+        fat_sectors,
+        0,  # both FATs active and mirrored
+        0,  # version 0.0
+        FAT32_ROOT_CLUSTER,
+        1,  # FSInfo sector
+        6,  # backup boot sector
+        0x80,
+        0x29,
+        int.from_bytes(os.urandom(4), "little"),
+        volume_label,
+        b"FAT32   ",
+    )
+    boot[510:512] = b"\x55\xaa"
+
+    fsinfo = bytearray(SECTOR_SIZE)
+    struct.pack_into("<I", fsinfo, 0, 0x41615252)
+    struct.pack_into("<IIII", fsinfo, 484, 0x61417272, clusters - 1, FAT32_ROOT_CLUSTER + 1, 0)
+    struct.pack_into("<I", fsinfo, 508, 0xAA550000)
+
+    # Entries 0 and 1 are reserved; entry 2 ends the single-cluster root chain.
+    fat = struct.pack("<III", 0x0FFFFFF8, 0x0FFFFFFF, 0x0FFFFFFF)
+
+    now = datetime.now()
+    label_entry = bytearray(32)
+    label_entry[0:11] = volume_label
+    label_entry[11] = 0x08  # ATTR_VOLUME_ID
+    struct.pack_into(
+        "<HH",
+        label_entry,
+        22,
+        (now.hour << 11) | (now.minute << 5) | (now.second // 2),
+        ((now.year - 1980) << 9) | (now.month << 5) | now.day,
+    )
 
-def mtools_copy_file(image: Path, src: Path, rel_dest: str) -> None:
-    run(["mcopy", "-i", f"{image}@@{PARTITION_OFFSET_BYTES}", str(src), f"::{rel_dest}"])
+    writes = [
+        (0, bytes(boot)),
+        (SECTOR_SIZE, bytes(fsinfo)),
+        (6 * SECTOR_SIZE, bytes(boot)),
+        (7 * SECTOR_SIZE, bytes(fsinfo)),
+    ]
+    for i in range(FAT32_NUM_FATS):
+        writes.append(((FAT32_RESERVED_SECTORS + i * fat_sectors) * SECTOR_SIZE, fat))
+    writes.append((data_start * SECTOR_SIZE, bytes(label_entry)))
+    return writes
 
 
-def populate_image_from_layout(layout_dir: Path, output_image: Path) -> list[dict]:
+def create_partitioned_image(
+    output_image: Path, size_mb: int, label: str, builtin_format: bool = False
+) -> None:
+    output_image.parent.mkdir(parents=True, exist_ok=True)
+    if not builtin_format:
+        run(["truncate", "-s", f"{size_mb}M", str(output_image)])
+        run(["parted", "-s", str(output_image), "mklabel", "msdos"])
+        run(["parted", "-s", str(output_image), "mkpart", "primary", "fat32", "1MiB", "100%"])
+        run(["parted", "-s", str(output_image), "set", "1", "boot", "on"])
+        run(
+            [
+                "mformat",
+                "-i",
+                f"{output_image}@@{PARTITION_OFFSET_BYTES}",
+                "-F",
+                "-v",
+                label,
+                "::",
+            ]
+        )
+        return
+
+    # The layout is fixed (MBR + one FAT32 partition at 1 MiB), so write the
+    # few non-zero structures directly into a sparse, zero-filled file.
+    image_bytes = size_mb * 1024 * 1024
+    if image_bytes // SECTOR_SIZE > 0xFFFFFFFF:
+        raise RuntimeError(
+            f"Image size {size_mb} MB exceeds the 2 TiB limit of an MBR partition table"
+        )
+    # Whole tracks only: some mtools releases reject a FAT whose total sector
+    # count is not a multiple of the BPB's sectors per track. The few sectors
+    # dropped stay inside the partition, unused.
+    volume_sectors = (image_bytes - PARTITION_OFFSET_BYTES) // SECTOR_SIZE
+    volume_sectors -= volume_sectors % SECTORS_PER_TRACK
+    volume = build_fat32_volume(volume_sectors, label)
+    with output_image.open("wb") as f:
+        f.truncate(image_bytes)
+        f.write(build_mbr(image_bytes // SECTOR_SIZE))
+        for offset, data in volume:
+            f.seek(PARTITION_OFFSET_BYTES + offset)
+            f.write(data)
+
+
+def mtools_copy_files(
+    image: Path, layout_dir: Path, dirs: list[Path], files: list[Path]
+) -> None:
+    # One mmd for the whole directory tree and one mcopy per destination
+    # directory, instead of a process per directory and file. Sources are
+    # exactly the walked files, so the image matches the manifest; entries the
+    # walk skips (dangling symlinks, special files, symlinked directories) are
+    # never handed to mtools.
+    target = f"{image}@@{PARTITION_OFFSET_BYTES}"
+    if dirs:
+        run(["mmd", "-i", target, *[f"::{d.relative_to(layout_dir).as_posix()}" for d in dirs]])
+
+    by_parent: dict[str, list[str]] = {}
+    for src in files:
+        parent = src.relative_to(layout_dir).parent.as_posix()
+        by_parent.setdefault("" if parent == "." else parent, []).append(str(src))
+    for parent, sources in by_parent.items():
+        run(["mcopy", "-Q", "-i", target, *sources, f"::{parent}"])
+
+
+def pyfatfs_copy_files(
+    image: Path, layout_dir: Path, dirs: list[Path], files: list[Path]
+) -> None:
+    # Holds the image open for the whole copy, so the FAT is parsed once rather
+    # than by every mtools process.
+    try:
+        with PyFatFS(str(image), offset=PARTITION_OFFSET_BYTES) as fat:
+            for d in dirs:
+                fat.makedir(d.relative_to(layout_dir).as_posix())
+            for src in files:
+                with src.open("rb") as f:
+                    fat.upload(src.relative_to(layout_dir).as_posix(), f)
+    except (FSError, PyFATException) as exc:
+        raise RuntimeError(f"Failed to populate image with pyfatfs: {exc}") from exc
+
+
+def populate_image_from_layout(
+    layout_dir: Path, output_image: Path, use_pyfatfs: bool = False
+) -> list[dict]:
     files = list(iter_layout_files(layout_dir))
     if not files:
         raise RuntimeError(f"Layout directory contains no files: {layout_dir}")
-
-    created_dirs: set[str] = set()
-    copied_entries: list[dict] = []
-
-    for src in files:
-        rel = src.relative_to(layout_dir).as_posix()
-        parent = str(Path(rel).parent).replace("\\", "/")
-        if parent == ".":
-            parent = ""
-
-        if parent:
-            parts = parent.split("/")
-            acc = ""
-            for part in parts:
-                acc = f"{acc}/{part}" if acc else part
-                if acc not in created_dirs:
-                    mtools_mkdir(output_image, acc)
-                    created_dirs.add(acc)
-
-        mtools_copy_file(output_image, src, rel)
-        copied_entries.append(
+    dirs = list(iter_layout_dirs(layout_dir))
+
+    # hashlib releases the GIL, so files are hashed on worker threads while
+    # the image is populated. Paths resolving to the same inode (hard links,
+    # symlinks) share one hash job; a cheaper content probe could collide.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+        digests: dict[object, Future[str]] = {}
+        pending: list[tuple[Path, int, Future[str]]] = []
+        for src, st in files:
+            # DirEntry.stat() reports no inode on Windows; fall back to the path.
+            key = (st.st_dev, st.st_ino) if st.st_ino else src
+            if key not in digests:
+                digests[key] = pool.submit(sha256_file, src)
+            pending.append((src, st.st_size, digests[key]))
+
+        copy_files = pyfatfs_copy_files if use_pyfatfs else mtools_copy_files
+        copy_files(output_image, layout_dir, dirs, [src for src, _ in files])
+        return [
             {
-                "relativePath": rel,
-                "sizeBytes": src.stat().st_size,
-                "sha256": sha256_file(src),
+                "relativePath": src.relative_to(layout_dir).as_posix(),
+                "sizeBytes": size,
+                "sha256": digest.result(),
             }
-        )
-
-    return copied_entries
+            for src, size, digest in pending
+        ]
 
 
 def flash_image(image: Path, device: str) -> None:
@@ -173,28 +419,25 @@ def write_manifest(
     args: argparse.Namespace,
     copied_entries: list[dict],
     output_image: Path,
+    output_image_sha256: str,
 ) -> None:
     manifest = {
-        "generatedAt": subprocess.run(
-            ["date", "-u", "+%Y-%m-%dT%H:%M:%SZ"],
-            check=True,
-            text=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        ).stdout.strip(),
+        "generatedAt": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
         "layoutDir": str(Path(args.layout_dir).resolve()),
         "outputImage": str(output_image.resolve()),
         "imageSizeMB": args.size_mb,
         "partitionOffsetBytes": PARTITION_OFFSET_BYTES,
         "volumeLabel": args.volume_label,
-        "outputImageSha256": sha256_file(output_image),
+        "outputImageSha256": output_image_sha256,
         "files": copied_entries,
     }
     if args.flash_device:
         manifest["flashDevice"] = args.flash_device
 
     manifest_path.parent.mkdir(parents=True, exist_ok=True)
-    manifest_path.write_text(json.dumps(manifest, indent=2) + "\n", encoding="utf-8")
+    with manifest_path.open("w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
 
 
 def main() -> int:
@@ -202,8 +445,9 @@ def main() -> int:
     layout_dir = Path(args.layout_dir).resolve()
     output_image = Path(args.output_image).resolve()
 
-    if args.size_mb < 32:
-        print("ERROR: --size-mb must be at least 32", file=sys.stderr)
+    min_size_mb = 34 if args.builtin_format else 32
+    if args.size_mb < min_size_mb:
+        print(f"ERROR: --size-mb must be at least {min_size_mb}", file=sys.stderr)
         return 2
 
     if not layout_dir.exists() or not layout_dir.is_dir():
@@ -214,6 +458,10 @@ def main() -> int:
         print(f"ERROR: output image exists (use --force): {output_image}", file=sys.stderr)
         return 2
 
+    if args.pyfatfs and PyFatFS is None:
+        print("ERROR: --pyfatfs requires the pyfatfs package to be installed", file=sys.stderr)
+        return 2
+
     if args.flash_device and args.confirm_flash_device != args.flash_device:
         print(
             "ERROR: flash confirmation mismatch. "
@@ -223,24 +471,33 @@ def main() -> int:
         return 2
 
     try:
-        ensure_tools_exist()
+        ensure_tools_exist(REQUIRED_TOOLS + (() if args.builtin_format else FORMAT_TOOLS))
         if output_image.exists() and args.force:
             output_image.unlink()
 
-        create_partitioned_image(output_image, args.size_mb, args.volume_label)
-        copied_entries = populate_image_from_layout(layout_dir, output_image)
-
-        run(["mdir", "-i", f"{output_image}@@{PARTITION_OFFSET_BYTES}", "::"])
-
-        if args.flash_device:
-            flash_image(output_image, args.flash_device)
-
-        manifest_path = (
-            Path(args.manifest_out).resolve()
-            if args.manifest_out
-            else output_image.with_suffix(".manifest.json")
+        create_partitioned_image(
+            output_image, args.size_mb, args.volume_label, args.builtin_format
         )
-        write_manifest(manifest_path, args, copied_entries, output_image)
+        copied_entries = populate_image_from_layout(layout_dir, output_image, args.pyfatfs)
+
+        # The image is complete at this point and only read from here on, so
+        # hash it while mdir lists it and dd flashes it.
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            image_digest = pool.submit(sha256_file, output_image)
+
+            run(["mdir", "-i", f"{output_image}@@{PARTITION_OFFSET_BYTES}", "::"])
+
+            if args.flash_device:
+                flash_image(output_image, args.flash_device)
+
+            manifest_path = (
+                Path(args.manifest_out).resolve()
+                if args.manifest_out
+                else output_image.with_suffix(".manifest.json")
+            )
+            write_manifest(
+                manifest_path, args, copied_entries, output_image, image_digest.result()
+            )
 
         print(f"Created image: {output_image}")
         print(f"Manifest: {manifest_path}")